@@ -17,13 +17,22 @@
 
 """
 
-import threading
-import copy
 import time
 import json
-import yaml
 import config as cfg
 
+# Optional; faster serialization of MQTT JSON messages
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Only required to migrate measurement files written by previous versions (YAML)
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
 # Logging
 import __main__
 import logging
@@ -32,79 +41,165 @@ script = os.path.basename(__main__.__file__)
 script = os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." + __name__)
 
+# S0PCM data inputs, in telegram order
+CHANNELS = ("M1", "M2", "M3", "M4", "M5")
+
 
-class ParseTelegrams(threading.Thread):
+class ParseTelegrams:
   """
+  Called by the serial reader thread for each received telegram
   """
 
-  def __init__(self, trigger, stopper, mqtt, telegram):
+  def __init__(self, mqtt):
     """
     Args:
-      :param threading.Event() trigger: signals that new telegram is available
-      :param threading.Event() stopper: stops thread
       :param mqtt.mqttclient() mqtt: reference to mqtt worker
-      :param list() telegram: dsmr telegram
     """
-    logger.debug(">>")
-    super().__init__()
-    self.__trigger = trigger
-    self.__stopper = stopper
-    self.__telegram = telegram
     self.__all_values = []
     self.__prev_all_values = []
 
-    # YAML measurement values read from file / stored to file
+    # previous s0pcm data record, as received
+    self.__prev_raw = ""
+
+    # JSON measurement values read from file / stored to file
     # These are initial values used when file is not present
     self.__measurements = {1: {'total': 0}, 2: {'total': 0}, 3: {'total': 0}, 4: {'total': 0}, 5: {'total': 0}, 'date': 0}
     self.__mqtt = mqtt
     self.__measurements_file_name = ""
-    self.__write_counter = 0
+    # epoch of last successful write of measurements to file
+    self.__last_write_ts = 0
+
+    # Default for config files of previous versions, without WRITE_INTERVAL_SEC
+    self.__write_interval = getattr(cfg, "WRITE_INTERVAL_SEC", 300)
 
     # Todo fix? Make it configurable?
     BASEPATH = os.path.dirname(os.path.realpath(__file__))
     self.__measurements_file_name = BASEPATH + "/" + cfg.MEASUREMENTFILE
 
-  def __del__(self):
-    logger.debug(">>")
+    # Config of previous versions refers to measurement.yaml; values are stored as JSON in measurement.json
+    file_name, extension = os.path.splitext(self.__measurements_file_name)
+    if extension in (".yaml", ".yml"):
+      self.__measurements_file_name = file_name + ".json"
+
+    # make resilient against double forward slashes in topic
+    self.__topic = cfg.MQTT_TOPIC_PREFIX.replace('//', '/')
+
+    # Friendly names of M1..M5 (see config.py); None if input is not used
+    self.__friendly_names = tuple(cfg.S0_DEFINITION[channel] for channel in CHANNELS)
+
+    # Named values and epoch of last published MQTT message
+    self.__last_published_values = None
+    self.__last_published_ts = 0
+
+    # Default for config files of previous versions, without MIN_PUBLISH_INTERVAL
+    self.__min_publish_interval = getattr(cfg, "MIN_PUBLISH_INTERVAL", 60)
+
+    # Template of MQTT JSON message; all keys which are published
+    self.__json_template = {"timestamp": 0, "counter": 0, "serial": ""}
+    if cfg.INFLUXDB:
+      self.__json_template["database"] = cfg.INFLUXDB
+    for jsonkey in self.__friendly_names:
+      if jsonkey is not None:
+        self.__json_template[jsonkey] = 0
 
   def __read_measurements(self):
     """
     Read stored values from file
+    Raises ValueError if file exists but cannot be used; the file is not overwritten
     """
-    logger.debug(">>")
     # measurement['date'] = datetime.date.today()
 
+    migrated_file_name = None
     try:
       with open(self.__measurements_file_name, 'r') as f:
-        self.__measurements = yaml.safe_load(f)
+        measurements = json.load(f)
+    except FileNotFoundError as e:
+      # Only migrate when there is no JSON file yet; never overwrite JSON values with stale YAML values
+      migrated_file_name, measurements = self.__read_legacy_measurements()
+      if measurements is None:
+        logger.warning(f"File {self.__measurements_file_name} exception {e}")
+        return
     except Exception as e:
-      logger.warning(f"File {self.__measurements_file_name} exception {e}")
-      return
+      # Do not continue with zero totals; these would overwrite the stored totals on next write
+      logger.error(f"File {self.__measurements_file_name} cannot be read; fix or remove file. Exception {e}")
+      raise ValueError('Cannot read measurement file', self.__measurements_file_name)
+
+    if not isinstance(measurements, dict) or \
+       not all(isinstance(value, dict) for key, value in measurements.items() if key != 'date'):
+      logger.error(f"File {self.__measurements_file_name} has an unexpected format; fix or remove file")
+      raise ValueError('Unexpected format of measurement file', self.__measurements_file_name)
+
+    # JSON stores the M1..M5 keys as strings; convert back to int
+    self.__measurements = {(int(key) if str(key).isdigit() else key): value for key, value in measurements.items()}
+
+    # Add missing M1..M5 totals (eg incomplete or manually edited file)
+    for i in range(1, 6):
+      self.__measurements.setdefault(i, {'total': 0})
+      self.__measurements[i].setdefault('total', 0)
+    self.__measurements.setdefault('date', 0)
+
+    # Store migrated values as JSON immediately and rename YAML file, so it cannot be read again
+    if migrated_file_name is not None and self.__write_measurements(throttle=False):
+      try:
+        os.replace(migrated_file_name, migrated_file_name + ".migrated")
+      except Exception as e:
+        logger.error(f"File {migrated_file_name} exception {e}")
 
-    logger.debug(f"YAML = {self.__measurements_file_name}")
-    logger.debug("<<")
+    logger.debug("JSON = %s", self.__measurements_file_name)
+
+  def __read_legacy_measurements(self):
+    """
+    Read stored values from YAML file (measurement.yaml), as written by previous versions
+
+    Returns:
+      tuple (YAML file name, dict with measurements), or (None, None) if not available
+    """
+
+    if yaml is None:
+      return None, None
+
+    file_name = os.path.splitext(self.__measurements_file_name)[0] + ".yaml"
+    try:
+      with open(file_name, 'r') as f:
+        measurements = yaml.safe_load(f)
+    except Exception as e:
+      logger.debug("File %s exception %s", file_name, e)
+      return None, None
+
+    if not isinstance(measurements, dict):
+      return None, None
+
+    logger.info(f"Migrate YAML values from {file_name} to {self.__measurements_file_name}")
+    return file_name, measurements
 
   def __write_measurements(self, throttle=False):
     """
     Write current values to file
+
+    Returns:
+      bool: True if values have been written
     """
-    logger.debug(">>")
 
-    # reduce nrof writes to disk
+    # reduce nrof writes to disk; write at most once per WRITE_INTERVAL_SEC
+    # Caller only requests a throttled write when values have changed
     if throttle:
-      self.__write_counter += 1
-      if self.__write_counter < 10:
-        return
+      if time.time() - self.__last_write_ts < self.__write_interval:
+        return False
       else:
-        self.__write_counter = 0
-        logger.debug(f"Save values to {self.__measurements_file_name}")
+        logger.debug("Save values to %s", self.__measurements_file_name)
 
+    # Write to temporary file and rename, to prevent a corrupted file when interrupted while writing
+    temp_file_name = self.__measurements_file_name + ".tmp"
     try:
-      with open(self.__measurements_file_name, 'w') as f:
-        yaml.dump(self.__measurements, f, default_flow_style=False)
+      with open(temp_file_name, 'w') as f:
+        json.dump(self.__measurements, f, separators=(',', ':'))
+      os.replace(temp_file_name, self.__measurements_file_name)
     except Exception as e:
       logger.error(f"File {self.__measurements_file_name} exception {e}")
-      return
+      return False
+
+    self.__last_write_ts = time.time()
+    return True
 
   def __publish_telegram(self, json_dict):
     """
@@ -114,48 +209,47 @@ class ParseTelegrams(threading.Thread):
     :return:
     """
 
-    # make resilient against double forward slashes in topic
-    topic = cfg.MQTT_TOPIC_PREFIX
-    topic = topic.replace('//', '/')
-    message = json.dumps(json_dict, sort_keys=True, separators=(',', ':'))
-    self.__mqtt.do_publish(topic, message, retain=False)
+    # Skip if named values are identical to previously published message
+    # (eg only an unnamed Mx input changed), unless MIN_PUBLISH_INTERVAL has elapsed
+    values = tuple(json_dict[jsonkey] for jsonkey in self.__friendly_names if jsonkey is not None)
+    ts = json_dict["timestamp"]
+    if values == self.__last_published_values and ts - self.__last_published_ts < self.__min_publish_interval:
+      logger.debug("Skip publish; no change in named values")
+      return
+
+    if orjson is not None:
+      # bytes; accepted as payload by paho-mqtt
+      message = orjson.dumps(json_dict, option=orjson.OPT_SORT_KEYS)
+    else:
+      message = json.dumps(json_dict, sort_keys=True, separators=(',', ':'))
+    self.__mqtt.do_publish(self.__topic, message, retain=False)
+    self.__last_published_values = values
+    self.__last_published_ts = ts
 
   def __decode_telegram_element(self, element, jsonvalues):
     """
 
     :param element: the part of telegram to be decoded
-    :param jsonvalues: store the retrieved values
+    :param jsonvalues: store the retrieved serial
     :return:
     """
 
     # Split data into an array
     # ID:21434:I:10:M1:0:100:M2:0:0:M3:0:100:M4:0:56:M5:0:1
+    # Layout is fixed; serial at index 1, channel Mx label at 4, 7, 10, 13, 16
+    # followed by delta counter and total counter
     s0array = element.split(':')
 
-    # Capture serial and remove from array (and "I:digit") - ID:21434:I:10:
-    s0array.pop(0)
-    jsonvalues["serial"] = str(s0array[0])
-    s0array.pop(0)
-    s0array.pop(0)
-    s0array.pop(0)
+    # Capture serial - ID:21434:I:10:
+    jsonvalues["serial"] = s0array[1]
 
-    # Loop through 5 s0pcm data inputs
+    # 5 s0pcm data inputs
     # M1:0:104647:M2:0:0:M3:2:1418:M4:0:56:M5:0:0
-    for count in range(5):
-
-      # channel is eg M1
-      channel = s0array[0]
-
-      # 2nd element is total since power-on of S0PCM device
-      pulsecounter = int(s0array[2])
-      jsonvalues[channel] = pulsecounter
-
-      # Remove M1, delta counter and total counter
-      s0array.pop(0)
-      s0array.pop(0)
-      s0array.pop(0)
+    # store all M1..M5 totals since power-on of S0PCM device as list
+    # add a dummy 0th element, as all indices later on count from 1 to 5 (M1 to M5)
+    self.__all_values = [0, int(s0array[6]), int(s0array[9]), int(s0array[12]), int(s0array[15]), int(s0array[18])]
 
-  def __decode_telegrams(self, telegram):
+  def decode_telegrams(self, telegram):
     """
     Args:
       :param list telegram: s0pcm telegram; preceded with counter
@@ -163,27 +257,23 @@ class ParseTelegrams(threading.Thread):
     Returns: None
 
     """
-    logger.debug(f">>")
-    json_values = dict()
-
-    # epoch, mqtt timestamp
-    ts = int(time.time())
 
     # get counter and remove from telegram list
     counter = telegram[0]
     telegram.pop(0)
 
-    # Build a dict of key:value, for MQTT JSON
-    json_values["timestamp"] = ts
-    json_values["counter"] = counter
+    # Skip if data record is identical to previous one; there are no changes
+    if telegram[0] == self.__prev_raw:
+      return
 
-    if cfg.INFLUXDB:
-      json_values["database"] = cfg.INFLUXDB
+    json_values = self.__json_template.copy()
 
-    self.__all_values.clear()
+    # epoch, mqtt timestamp
+    ts = int(time.time())
 
-    # add a dummy 0th element, as all indices later on count from 1 to 5 (M1 to M5)
-    self.__all_values.append(0)
+    # Fill dict of key:value, for MQTT JSON
+    json_values["timestamp"] = ts
+    json_values["counter"] = counter
 
     # This is a bit artificial, as telegram has only one element (the 5 s0pcm values)
     # But this is the generic design I use for all parsers
@@ -191,82 +281,61 @@ class ParseTelegrams(threading.Thread):
     #  self.__decode_telegram_element(element, json_values)
     # This is shorter.....
     self.__decode_telegram_element(telegram[0], json_values)
-
-    # store all M1..M5 values as list
-    for i in range(1, 6):
-      self.__all_values.append(json_values["M" + str(i)])
+    self.__prev_raw = telegram[0]
 
     # One time initialization
     if len(self.__prev_all_values) == 0:
-      self.__prev_all_values = copy.deepcopy(self.__all_values)
+      self.__prev_all_values = self.__all_values
+
+    # local references; lists and dict are only modified in place below
+    all_values = self.__all_values
+    prev_all_values = self.__prev_all_values
+    measurements = self.__measurements
 
     # Compare list with M1..M5 values with previous one
     # Skip if there are no changes
-    if self.__all_values != self.__prev_all_values:
-      logger.debug(f"Change detected")
+    if all_values != prev_all_values:
+      logger.debug("Change detected")
       for i in range(1, 6):
         # Calculate difference between current and previous measurement
         # Normal operation: Current value >= previous value
-        if self.__all_values[i] >= self.__prev_all_values[i]:
-          delta = self.__all_values[i] - self.__prev_all_values[i]
-          logger.debug(f"M{i}: delta={delta}")
+        if all_values[i] >= prev_all_values[i]:
+          delta = all_values[i] - prev_all_values[i]
+          logger.debug("M%d: delta=%d", i, delta)
         else:
           logger.warning(f"Power down detected for M{i}")
           # Current value < previous value
           # This happens when s0pcm module is powered down during operation
           # which resets internal counters
           delta = 0
-          self.__prev_all_values[i] = self.__all_values[i]
+          prev_all_values[i] = all_values[i]
 
         # Update total by adding delta to previous total
-        try:
-          self.__measurements[i]["total"] += delta
-        except IndexError:
-          # this should only happens when measurements file was non existent
-          self.__measurements[i]["total"] = self.__all_values[i]
+        measurements[i]["total"] += delta
 
-      for i in range(1, 6):
-        json_values["M" + str(i)] = self.__measurements[i]["total"]
-
-      # replace Mx labels with named labels (see config.py)
+      # add totals with named labels (see config.py)
       # eg M1 --> jacuzzi
-      for i in range(1, 6):
-        jsonkey = cfg.S0_DEFINITION["M" + str(i)]
+      # skip the Mx inputs which have a "None" as friendly name; these are not in the template
+      for i, jsonkey in enumerate(self.__friendly_names, start=1):
         if jsonkey is not None:
-          # replace the Mx key:value pairs with new friendly name key:value
-          json_values[jsonkey] = json_values.pop("M" + str(i))
-        else:
-          # remove the Mx key:value pairs which have a "None" as friendly name
-          json_values.pop("M" + str(i))
+          json_values[jsonkey] = measurements[i]["total"]
 
-      logger.debug(f"json_values = {json_values}")
+      logger.debug("json_values = %s", json_values)
 
       self.__publish_telegram(json_values)
-      self.__measurements["date"] = ts
+      measurements["date"] = ts
       self.__write_measurements(throttle=True)
-      self.__prev_all_values = copy.deepcopy(self.__all_values)
-
-  def run(self):
-    logger.debug(">>")
+      self.__prev_all_values = all_values
 
+  def open(self):
+    """
+    Read stored measurement values; call before first telegram is decoded
+    """
     self.__read_measurements()
-    logger.debug(f"YAML = {self.__measurements}")
-
-    while not self.__stopper.is_set():
-      # block till event is set, but implement timeout to allow stopper
-      self.__trigger.wait(timeout=1)
-      if self.__trigger.is_set():
-        # Make copy of the telegram, for further parsing
-        telegram = copy.deepcopy(self.__telegram)
-
-        # Clear telegram list for next capture by ReadSerial class
-        self.__telegram.clear()
+    logger.debug("JSON = %s", self.__measurements)
 
-        # Clear trigger, serial reader can continue
-        self.__trigger.clear()
-
-        self.__decode_telegrams(telegram)
-
-    # write measurements when closing
+  def close(self):
+    """
+    Write measurement values when closing
+    """
     self.__write_measurements(throttle=False)
-    logger.debug("<<")
@@ -28,7 +28,7 @@ Pulse vs liter vs m3
 I use the S0PCM-Reader to measure my water meter and normally in the Netherlands the water usage is
 easurement in m3 and not in liters. Only this S0PCM-Reader isn't really aware of liters vs m3, be
 cause it counts the pulses. So it is important for you to check how your e.g. water meter is counting
-the usage, my Itron water meter send 1 pulse per liter of water. This then means the 'measurement.yaml' file,
+the usage, my Itron water meter send 1 pulse per liter of water. This then means the 'measurement.json' file,
 which stores the total and daily counters, all should be in liters and not in m3.
 The conversion from m3 to liter is easy, because you can just multiple it by 1000.
 E.g. 770.123 m3 is 770123 liter.
@@ -79,6 +79,7 @@ import serial
 import threading
 import time
 import re
+import select
 
 import config as cfg
 
@@ -91,25 +92,34 @@ script = os.path.basename(__main__.__file__)
 script = os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." + __name__)
 
+# Basic input validation, S0PCM-5 data record
+TELEGRAM_RE = re.compile(r"^ID:\d+:I:\d+:M1:\d+:\d+:M2:\d+:\d+:M3:\d+:\d+:M4:\d+:\d+:M5:\d+:\d+")
+
+# A telegram is less than 100 characters; received data without end of line beyond this length is dropped
+MAX_LINE_LENGTH = 1024
+
+# select() on a serial port is only supported on POSIX; otherwise use a read with timeout
+USE_SELECT = (os.name == "posix")
+
 
 class TaskReadSerial(threading.Thread):
 
-  def __init__(self, trigger, stopper, telegram):
+  def __init__(self, stopper, parser):
     """
 
     Args:
-      :param threading.Event() trigger: signals that new telegram is available
       :param threading.Event() stopper: stops thread
-      :param list() telegram: dsmr telegram
+      :param S0_parser.ParseTelegrams() parser: decodes telegrams to MQTT messages
     """
 
-    logger.debug(">>")
     super().__init__()
-    self.__trigger = trigger
     self.__stopper = stopper
-    self.__telegram = telegram
+    self.__parser = parser
     self.__counter = 0
 
+    # Received bytes which do not (yet) form a complete line
+    self.__rxbuf = bytearray()
+
     # [ Serial parameters ]
     if cfg.PRODUCTION:
       self.__tty = serial.Serial()
@@ -120,12 +130,15 @@ class TaskReadSerial(threading.Thread):
       self.__tty.stopbits = serial.STOPBITS_ONE
       self.__tty.xonxoff = 0
       self.__tty.rtscts = 0
-      self.__tty.timeout = 20
+
+      # Non blocking; __read_line() waits for data with select()
+      # Otherwise read blocks max 1 sec
+      self.__tty.timeout = 0 if USE_SELECT else 1
 
     try:
       if cfg.PRODUCTION:
         self.__tty.open()
-        logger.debug(f"serial {self.__tty.port} opened")
+        logger.debug("serial %s opened", self.__tty.port)
       else:
         self.__tty = open(cfg.SIMULATORFILE, 'rb')
 
@@ -134,67 +147,89 @@ class TaskReadSerial(threading.Thread):
       self.__stopper.set()
       raise ValueError('Cannot open P1 serial port', cfg.ser_port)
 
-  def __del__(self):
-    logger.debug(">>")
+  def __read_line(self):
+    """
+      Read one line from serial port
+      Wait max 1 sec for data, to allow stopper
+      In non-production mode, reads line from file
+
+    Returns:
+      str: line, decoded from binary to ascii and CR LF removed
+      None: no complete line received within 1 sec
+    """
+
+    if not cfg.PRODUCTION:
+      return self.__tty.readline().decode('utf-8').rstrip()
+
+    while b"\n" not in self.__rxbuf:
+      # Line noise without end of line; do not let buffer grow without limit
+      if len(self.__rxbuf) > MAX_LINE_LENGTH:
+        logger.warning(f"No end of line received within {MAX_LINE_LENGTH} bytes; data dropped")
+        self.__rxbuf = bytearray()
+
+      if USE_SELECT:
+        readable, _, _ = select.select([self.__tty.fileno()], [], [], 1.0)
+        if not readable:
+          return None
+        data = self.__tty.read(self.__tty.in_waiting or 1)
+      else:
+        data = self.__tty.read(self.__tty.in_waiting or 1)
+        if not data:
+          return None
+      self.__rxbuf += data
+
+    line, _, self.__rxbuf = self.__rxbuf.partition(b"\n")
+    return line.decode('utf-8', 'replace').rstrip()
 
   def __read_serial(self):
     """
       Opens & Closes serial port
-      Reads S0 telegrams; stores in global variable (self.__telegram)
-      Sets threading event to signal other clients (parser) that
-      new telegram is available.
+      Reads S0 telegrams; passes each valid telegram to the parser
       In non-production mode, reads telegrams from file
 
     Returns:
       None
     """
-    logger.debug(">>")
 
-    while not self.__stopper.is_set():
+    # local references; attributes are not reassigned within the loop
+    stopper = self.__stopper
+    parser = self.__parser
+    read_line = self.__read_line
 
-      # wait till parser has copied telegram content
-      # ...we need the opposite of trigger.wait()...block when set; not available
-      while self.__trigger.is_set():
-        time.sleep(0.1)
+    while not stopper.is_set():
+      line = read_line()
+      if line is None:
+        continue
+      logger.debug("Line read from s0pcm=%s", line)
 
-      # add a counter as first field to the list
       self.__counter += 1
-      self.__telegram.append(f"{self.__counter}")
-
-      # Decode from binary to ascii
-      # Remove CR LF
-      line = self.__tty.readline().decode('utf-8').rstrip()
-      logger.debug(f"Line read from s0pcm={line}")
 
       # Only in simulator mode; detect EOF in file
       if (not cfg.PRODUCTION) and line.startswith('EOF'):
-        self.__stopper.set()
-        logger.debug(f"EOF Detected in {cfg.SIMULATORFILE}")
+        stopper.set()
+        logger.debug("EOF Detected in %s", cfg.SIMULATORFILE)
         break
 
       # Basic input validation
       #ID:21434:I:10:M1:0:104647:M2:0:0:M3:0:1416:M4:0:56:M5:0:0^M$
-      if not re.match(r"^ID:\d+:I:\d+:M1:\d+:\d+:M2:\d+:\d+:M3:\d+:\d+:M4:\d+:\d+:M5:\d+:\d+.*", line):
+      if not TELEGRAM_RE.match(line):
         logger.warning(f"Unexpected input received from s0pcm module = {line}")
-        self.__telegram.clear()
         continue
 
-      # append
-      self.__telegram.append(f"{line}")
-
-      # Trigger that new telegram is available for MQTT
-      self.__trigger.set()
+      # Decode telegram and publish as MQTT message; add a counter as first field to the list
+      parser.decode_telegrams([self.__counter, line])
 
       # In simulation mode, insert a delay
       if not cfg.PRODUCTION:
         # 0.5sec delay mimics dsmr behaviour, but 2x as fast, which transmits every 1sec a telegram
         time.sleep(0.5)
 
-    logger.debug("<<")
-
   def run(self):
-    logger.debug(">>")
+    parser_opened = False
     try:
+      self.__parser.open()
+      parser_opened = True
+
       # In production, ReadSerial has infinite loop
       # In simulation, ReadSerial will return @ EOF
       self.__read_serial()
@@ -204,6 +239,7 @@ class TaskReadSerial(threading.Thread):
 
     finally:
       self.__tty.close()
+      # Do not overwrite measurement file if it could not be read
+      if parser_opened:
+        self.__parser.close()
       self.__stopper.set()
-
-    logger.debug("<<")
@@ -26,7 +26,11 @@ SIMULATORFILE = "test/s0pcm.raw"
 
 # File where measurement data is stored
 # S0PCM module does not have a persistent memory
-MEASUREMENTFILE = "measurement.yaml"
+MEASUREMENTFILE = "measurement.json"
+
+# Minimal interval in seconds between writes of changed measurement data to MEASUREMENTFILE
+# Measurement data is always written when this program exits
+WRITE_INTERVAL_SEC = 300
 
 # All named inputs will be included in the MQTT message
 # All "None" inputs will be excluded from the MQTT message
@@ -47,10 +51,18 @@ MQTT_QOS = 1
 MQTT_USERNAME = "username"
 MQTT_PASSWORD = "password"
 
+# Keepalive interval in seconds; a lost connection to the broker is detected after ~1.5x MQTT_KEEPALIVE
+MQTT_KEEPALIVE = 60
+
 # Max nrof MQTT messages per second
 # Set to 0 for unlimited rate
 MQTT_RATE = 100
 
+# Changes of inputs with a "None" friendly name (see S0_DEFINITION) do not change the MQTT message
+# Such a message is only published when the previous one is older than MIN_PUBLISH_INTERVAL seconds
+# Set to 0 to publish every change
+MIN_PUBLISH_INTERVAL = 60
+
 if PRODUCTION:
   MQTT_TOPIC_PREFIX = "s0pcm"
 else:
@@ -19,7 +19,6 @@
 
 """
 import copy
-import time
 import threading
 import json
 
@@ -47,17 +46,15 @@ class Discovery(threading.Thread):
     :param str                  version: version of the program
     """
 
-    logger.debug(">>")
     super().__init__()
     self.__stopper = stopper
     self.__mqtt = mqtt
     self.__version = version
     self.__interval = 3600/cfg.HA_INTERVAL
-    self.__lastmqtt = 0
     self.__listofjsondicts = list()
 
-  def __del__(self):
-    logger.debug(">>")
+    # (topic, payload) per discovery message; created once in run()
+    self.__discovery_messages = list()
 
   def __create_discovery_JSON(self):
     """
@@ -76,6 +73,7 @@ class Discovery(threading.Thread):
     d["name"] = "s0pcm"
     d["unique_id"] = "s0pcm-device"
     d["state_topic"] = cfg.MQTT_TOPIC_PREFIX + "/status"
+    d["value_template"] = "{{value_json.state}}"
     d["icon"] = "mdi:home-automation"
     d["device"] = {"name": "s0pcm",
                    "sw_version": self.__version,
@@ -116,27 +114,29 @@ class Discovery(threading.Thread):
     Returns:
       None
     """
-    logger.debug(">>")
 
     self.__create_discovery_JSON()
 
-    # infinite loop
+    # Topics and payloads do not change; serialize and encode once
+    for d in self.__listofjsondicts:
+      topic = "homeassistant/sensor/" + cfg.HA_MQTT_DISCOVERY_TOPIC_PREFIX + "/" + d["unique_id"] + "/config"
+      self.__discovery_messages.append((topic, json.dumps(d, separators=(',', ':')).encode('utf-8')))
+
+    # infinite loop; publish at start-up and then once every interval
     if cfg.HA_DISCOVERY:
-      while not self.__stopper.is_set():
-        # calculate time elapsed since last MQTT
-        t_elapsed = int(time.time()) - self.__lastmqtt
-
-        if t_elapsed > self.__interval:
-          for dict in self.__listofjsondicts:
-            topic = "homeassistant/sensor/" + cfg.HA_MQTT_DISCOVERY_TOPIC_PREFIX + "/" + dict["unique_id"] + "/config"
-            self.__mqtt.do_publish(topic, json.dumps(dict, separators=(',', ':')), retain=True)
-            self.__lastmqtt = int(time.time())
-        else:
-          # wait...
-          time.sleep(0.5)
+      # local references; attributes are not reassigned within the loop
+      stopper = self.__stopper
+      do_publish = self.__mqtt.do_publish
+      discovery_messages = self.__discovery_messages
+
+      while not stopper.is_set():
+        for topic, payload in discovery_messages:
+          do_publish(topic, payload, retain=True)
+
+        # block till next interval; returns immediately when stopper is set
+        stopper.wait(timeout=self.__interval)
 
     # If configured, remove MQTT Auto Discovery configuration
     if cfg.HA_DELETECONFIG:
-      for dict in self.__listofjsondicts:
-        topic = "homeassistant/sensor/" + cfg.MQTT_TOPIC_PREFIX + "/" + dict["unique_id"] + "/config"
+      for topic, _payload in self.__discovery_messages:
         self.__mqtt.do_publish(topic, "")
@@ -43,9 +43,10 @@
 
 """
 
-import time
 import threading
+import queue
 import random
+import json
 import string
 import socket
 import paho.mqtt.client as mqtt_client
@@ -76,6 +77,8 @@ class MQTTClient(threading.Thread):
                mqtt_qos=1,
                mqtt_cleansession=True,
                mqtt_protocol=mqtt_client.MQTTv311,
+               mqtt_session_expiry=3600,
+               mqtt_keepalive=60,
                username="",
                password="",
                worker_threads_stopper=None):
@@ -90,6 +93,10 @@ class MQTTClient(threading.Thread):
       :param int mqtt_qos: MQTT QoS 0,1,2 for publish
       :param bool mqtt_cleansession:
       :param int mqtt_protocol: MQTT protocol version
+      :param int mqtt_session_expiry: MQTT v5 only; seconds the broker keeps the session
+      (subscriptions, queued QoS>0 messages) after a disconnect
+      :param int mqtt_keepalive: seconds between PINGREQs when idle; a dead connection is detected
+      after about 1.5x keepalive
       :param str username:
       :param str password:
       :param threading.Event() worker_threads_stopper: stopper event for other worker threads;
@@ -119,6 +126,7 @@ class MQTTClient(threading.Thread):
     self.__qos = mqtt_qos
     self.__mqtt_cleansession = mqtt_cleansession
     self.__mqtt_protocol = mqtt_protocol
+    self.__mqtt_session_expiry = mqtt_session_expiry
 
     if worker_threads_stopper is None:
       self.__worker_threads_stopper = self.__mqtt_stopper
@@ -150,12 +158,11 @@ class MQTTClient(threading.Thread):
     # Indicate whether thread has started - run() has been called
     self.__run = False
 
-    # Todo parameterize
-    self.__keepalive = 600
+    self.__keepalive = mqtt_keepalive
 
-    # MQTT client tries to force a reconnection if
-    # Client remains disconnected for more than MQTT_CONNECTION_TIMEOUT seconds
-    self.__MQTT_CONNECTION_TIMEOUT = 60
+    # paho loop thread reconnects when connection is lost
+    # Delay doubles after each failed attempt, from min_delay up to max_delay seconds
+    self.__mqtt.reconnect_delay_set(min_delay=1, max_delay=600)
 
     # Call back functions
     self.__mqtt.on_connect = self.__on_connect
@@ -180,16 +187,14 @@ class MQTTClient(threading.Thread):
 
     # Managed via __set_connected_flag()
     # Keeps track of connected status
-    self.__connected_flag = False
-
-    # Keep track how long client is disconnected
-    # When threshold is exceeded, try to recover
-    # In some cases, a MQTT_ERR_NOMEM is not recovered automatically
-    self.__disconnect_start_time = int(time.time())
+    self.__connected_event = threading.Event()
 
     # Maintain a mqtt message count
     self.__mqtt_counter = 0
 
+    # Last published retained payload per topic; used by do_publish(dedupe=True)
+    self.__last_payload = {}
+
     self.__mqtt.username_pw_set(username, password)
 
     # status topic & message
@@ -207,41 +212,20 @@ class MQTTClient(threading.Thread):
     # list of subscribed topics
     self.__list_of_subscribed_topics = []
 
+    # subscribed topics which could not be sent to broker (not connected)
+    self.__pending_subscribed_topics = []
+
   def __del__(self):
     logger.debug(f">>")
     logger.info(f"Shutting down MQTT Client... {self.__mqtt_counter} MQTT messages have been published")
 
-  def __internet_on(self):
-    """
-      Test if there is connectivity with the MQTT broker
-
-    Returns:
-      return: connectivity status (True, False)
-      rtype: bool
-    """
-    logger.debug(f">>")
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-      # Format: s.connect((HOST, PORT))
-      s.connect((f"{self.__mqtt_broker}", int(self.__mqtt_port)))
-      s.shutdown(socket.SHUT_RDWR)
-      logger.debug(f"Internet connectivity to MQTT broker {self.__mqtt_broker} at port {self.__mqtt_port} available")
-      return True
-    except Exception as e:
-      logger.info(f"Internet connectivity to MQTT broker {self.__mqtt_broker} at port {self.__mqtt_port} "
-                  f"NOT yet available; Exception {e}")
-      return False
-
   def __set_connected_flag(self, flag=True):
-    logger.debug(f">> flag={flag}; current __connected_flag={self.__connected_flag}")
-
-    # if flag == False and __connected_flag == True; start trigger
-    if not flag and self.__connected_flag:
-      self.__disconnect_start_time = int(time.time())
-      logger.debug("Disconnect TIMER started")
+    logger.debug(">> flag=%s; current connected=%s", flag, self.__connected_event.is_set())
 
-    self.__connected_flag = flag
+    if flag:
+      self.__connected_event.set()
+    else:
+      self.__connected_event.clear()
     return
 
   def __on_connect(self, _client, userdata, flags, rc, _properties=None):
@@ -252,23 +236,44 @@ class MQTTClient(threading.Thread):
       :param ? _client: the client instance for this callback
       :param ? userdata: the private user data as set in Client()
       :param dict flags: response flags sent by the broker
-      :param int rc: the connection result --> connack_dict
+      :param int rc: the connection result --> paho connack_string(rc)
       :param _properties: The MQTT v5.0 properties received from the broker.  A
               list of Properties class instances.
 
     Returns:
       None
     """
-    logger.debug(f">>")
+    logger.debug(">>")
     if rc == mqtt_client.CONNACK_ACCEPTED:
-      logger.debug(f"Connected: userdata={userdata}; flags={flags}; rc={rc}: {mqtt_client.connack_string(rc)}")
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Connected: userdata={userdata}; flags={flags}; rc={rc}: {mqtt_client.connack_string(rc)}")
       self.__set_connected_flag(True)
+
+      # Broker might have lost retained messages (eg restart); publish all retained messages again
+      self.__last_payload.clear()
+
+      # Send small MQTT packets immediately; do not wait for Nagle to coalesce them
+      sock = self.__mqtt.socket()
+      if sock is not None:
+        try:
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+          sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except OSError as e:
+          logger.warning(f"Cannot set socket options; Exception {e}")
+
       self.__set_status()
 
-      # Re-subscribe, in case connection was lost
-      for topic in self.__list_of_subscribed_topics:
-        logger.debug(f"Resubscribe topic: {topic}")
+      # Re-subscribe, in case connection was lost and broker did not keep the session
+      # If session is present, only subscribe topics which could not be sent while disconnected
+      if flags.get("session present"):
+        topics = self.__pending_subscribed_topics
+      else:
+        topics = self.__list_of_subscribed_topics
+
+      for topic in topics:
+        logger.debug("Resubscribe topic: %s", topic)
         self.__mqtt.subscribe(topic, self.__qos)
+      self.__pending_subscribed_topics = []
 
     else:
       logger.error(f"userdata={userdata}; flags={flags}; rc={rc}: {mqtt_client.connack_string(rc)}")
@@ -281,7 +286,7 @@ class MQTTClient(threading.Thread):
     Args:
       :param ? _client: the client instance for this callback
       :param ? userdata: the private user data as set in Client()
-      :param int rc: the disconnection result --> rc_dict
+      :param int rc: the disconnection result --> paho error_string(rc)
       :param _properties: The MQTT v5.0 properties received from the broker.  A
               list of Properties class instances.
 
@@ -300,12 +305,28 @@ class MQTTClient(threading.Thread):
     """
     :param _client:
     :param _userdata:
-    :param message: Queue()
+    :param message: MQTTMessage; stored as tuple (topic, payload, retain)
     :return:
     """
-    logger.debug(f">> message = {message.topic}  {message.payload}")
+    logger.debug(">> message = %s  %s", message.topic, message.payload)
+
+    # Runs on paho loop thread; keep short and never block
+    if self.__subscribed_queue is None:
+      return
 
-    self.__subscribed_queue.put(message)
+    item = (message.topic, bytes(message.payload), message.retain)
+    try:
+      self.__subscribed_queue.put_nowait(item)
+    except queue.Full:
+      # Slow consumer; drop oldest message
+      try:
+        self.__subscribed_queue.get_nowait()
+      except queue.Empty:
+        pass
+      try:
+        self.__subscribed_queue.put_nowait(item)
+      except queue.Full:
+        logger.warning("Subscription message queue is full; message dropped for topic %s", message.topic)
 
     # set event that message has been received
     if self.__message_trigger is not None:
@@ -323,7 +344,7 @@ class MQTTClient(threading.Thread):
     Returns:
       None
     """
-    logger.debug(f"userdata={userdata}; mid={mid}")
+    logger.debug("userdata=%s; mid=%s", userdata, mid)
     return None
 
   def __on_subscribe_v5(self, _client, _userdata, mid, reasoncodes, _properties=None):
@@ -337,10 +358,10 @@ class MQTTClient(threading.Thread):
                       list of Properties class instances.
     :return:
     """
-    logger.debug(f"Subscribed mid variable: {mid}")
+    logger.debug("Subscribed mid variable: %s", mid)
 
     for rc in reasoncodes:
-      logger.debug(f"reasonCode = {rc}")
+      logger.debug("reasonCode = %s", rc)
 
   def __on_subscribe_v31(self, _client, _userdata, mid, granted_qos):
     """
@@ -351,10 +372,10 @@ class MQTTClient(threading.Thread):
                         granted for each of the different subscription requests.
     :return:
     """
-    logger.debug(f"Subscribed mid variable: {mid}")
+    logger.debug("Subscribed mid variable: %s", mid)
 
     for qos in granted_qos:
-      logger.debug(f"Granted QoS = {qos}")
+      logger.debug("Granted QoS = %s", qos)
 
   def __on_unsubscribe(self, _client, _userdata, mid, _properties=None, _reasoncode=None):
     """
@@ -366,7 +387,7 @@ class MQTTClient(threading.Thread):
            list of Properties class instances.
     :return:
     """
-    logger.debug(f">> Unsubscribed: {mid}")
+    logger.debug(">> Unsubscribed: %s", mid)
 
   def __on_log(self, client, _userdata, level, buf):
     """
@@ -381,7 +402,7 @@ class MQTTClient(threading.Thread):
     Returns:
       None
     """
-    logger.debug(f"obj={client}; level={level}; buf={buf}")
+    logger.debug("obj=%s; level=%s; buf=%s", client, level, buf)
 
   def __set_status(self):
     """
@@ -401,11 +422,14 @@ class MQTTClient(threading.Thread):
     Will store status & resend on a reconnect
 
     :param str topic:
-    :param str payload:
+    :param str|dict payload: dict is serialized to JSON once (eg state and version in one message)
     :param bool retain:
     :return: None
     """
     logger.debug(">>")
+    if isinstance(payload, dict):
+      payload = json.dumps(payload, separators=(',', ':'))
+
     self.__status_topic = topic
     self.__status_payload = payload
     self.__status_retain = retain
@@ -417,7 +441,7 @@ class MQTTClient(threading.Thread):
     It is advised to call before self.run() is called
 
     :param str topic:
-    :param str payload:
+    :param str|dict payload: dict is serialized to JSON
     :param int qos:
     :param bool retain:
     :return: None
@@ -427,21 +451,31 @@ class MQTTClient(threading.Thread):
     if self.__run:
       logger.warning(f"Last Will/testament is set after run() is called. Not advised per documentation")
 
+    if isinstance(payload, dict):
+      payload = json.dumps(payload, separators=(',', ':'))
+
     self.__mqtt.will_set(topic, payload, qos, retain)
 
-  def do_publish(self, topic, message, retain=False):
+  def do_publish(self, topic, message, retain=False, dedupe=True):
     """
     Publish topic & message to MQTT broker
 
     Args:publish(topic, payload=None, qos=0, retain=False)
       :param str topic: MQTT topic
-      :param str message: MQTT message
+      :param str|bytes message: MQTT message; bytes are passed to paho as is, str is encoded to utf-8 by paho
       :param bool retain: retained flag MQTT message
+      :param bool dedupe: skip retained message if same payload has already been published to topic
+      (broker already has the correct value); memo is cleared on (re)connect
 
     Returns:
-      None
+      paho.mqtt.client.MQTTMessageInfo: or None if topic or message is invalid, or if message is skipped
     """
-    logger.debug(f">> TOPIC={topic}; MESSAGE={message}")
+    # Lazy formatting; message is only formatted when debug logging is enabled
+    logger.debug(">> TOPIC=%s; MESSAGE=%s", topic, message)
+
+    if retain and dedupe and self.__last_payload.get(topic) == message:
+      logger.debug("Skip unchanged retained message; TOPIC=%s", topic)
+      return None
 
     try:
       mqttmessageinfo = self.__mqtt.publish(topic=topic, payload=message, qos=self.__qos, retain=retain)
@@ -450,8 +484,12 @@ class MQTTClient(threading.Thread):
       if mqttmessageinfo.rc != mqtt_client.MQTT_ERR_SUCCESS:
         logger.warning(f"MQTT publish was not successfull, rc = {mqttmessageinfo.rc}: "
                        f"{mqtt_client.error_string(mqttmessageinfo.rc)}")
-    except ValueError:
-      logger.warning("")
+      elif retain:
+        self.__last_payload[topic] = message
+      return mqttmessageinfo
+    except ValueError as e:
+      logger.warning(f"MQTT publish failed for topic {topic}; {e}")
+      return None
 
   def set_message_trigger(self, subscribed_queue, trigger=None):
     """
@@ -459,7 +497,8 @@ class MQTTClient(threading.Thread):
     The received messages are stored in a queue
     If a message is received, trigger event will be set
 
-    :param subscribed_queue: Queue() - as received by on_message (topic, payload,..)
+    :param subscribed_queue: Queue() - received messages as tuple (topic, payload bytes, retain);
+      when a bounded queue is full, the oldest message is dropped
     :param trigger: threading.Event(); OPTIONAL: to indicate that message has been received
     :return:
     """
@@ -485,13 +524,16 @@ class MQTTClient(threading.Thread):
       return
 
     # Subscribing will not work if client is not connected
-    # Wait till there is a connection
-    # Todo....not required....just store in list, will be subscribe in on_connect()
-    # while not self.__connected_flag and not self.__mqtt_stopper.is_set():
-    #  logger.warning(f"No connection with MQTT Broker; cannot subscribe...wait for connection")
-    #  time.sleep(0.1)
+    # No need to wait for a connection; topic will be subscribed in on_connect()
+    if not self.__connected_event.is_set():
+      logger.debug("No connection with MQTT Broker; subscribe when connected")
+      self.__pending_subscribed_topics.append(topic)
+      return
 
-    self.__mqtt.subscribe(topic, self.__qos)
+    rc, _mid = self.__mqtt.subscribe(topic, self.__qos)
+    if rc != mqtt_client.MQTT_ERR_SUCCESS:
+      # Not connected; will be subscribed in on_connect()
+      self.__pending_subscribed_topics.append(topic)
     return
 
   def unsubscribe(self, topic):
@@ -506,6 +548,9 @@ class MQTTClient(threading.Thread):
     logger.debug(f">> topic = {topic}")
     self.__mqtt.unsubscribe(topic)
 
+    if topic in self.__pending_subscribed_topics:
+      self.__pending_subscribed_topics.remove(topic)
+
     try:
       self.__list_of_subscribed_topics.remove(topic)
     except ValueError:
@@ -513,29 +558,28 @@ class MQTTClient(threading.Thread):
                      f"did you use exact same topic as when subscribing?")
     return
 
+  def stop(self):
+    """
+    Stop the mqtt thread; the run() loop wakes up immediately
+    Typically called as last, after all worker threads have been stopped
+
+    :return: None
+    """
+    logger.debug(">>")
+    self.__mqtt_stopper.set()
+
   def run(self):
     logger.info(f"Broker = {self.__mqtt_broker}>>")
     self.__run = True
 
-    # Wait till there is network connectivity to mqtt broker
-    # Start with a small delay and incrementally (+20%) make larger
-    delay = 0.1
-    while not self.__internet_on():
-      time.sleep(delay)
-      delay = delay * 1.2
-
-      # Timeout after 60min
-      if delay > 3600:
-        logger.error(f"No internet connection - EXIT")
-        self.__mqtt_stopper.set()
-        self.__worker_threads_stopper.set()
-        return
-
+    # No need to wait for network connectivity to mqtt broker
+    # The paho loop thread retries the (first) connection, see reconnect_delay_set()
     try:
       # Options functions to be called before connecting
-      # Set queue to unlimitted (=65535) when qos>0
-      self.__mqtt.max_queued_messages_set(0)
-      self.__mqtt.reconnect_delay_set(min_delay=1, max_delay=360)
+      # paho buffers outgoing messages (qos>0) while not connected or when inflight window is full
+      # Limit memory usage when broker is not available for a long time
+      self.__mqtt.max_queued_messages_set(10000)
+      self.__mqtt.max_inflight_messages_set(20)
 
       # clean_session is only implemented for MQTT v3
       if self.__mqtt_protocol == mqtt_client.MQTTv311 or self.__mqtt_protocol == mqtt_client.MQTTv31:
@@ -543,22 +587,24 @@ class MQTTClient(threading.Thread):
                                   port=self.__mqtt_port,
                                   keepalive=self.__keepalive)
       elif self.__mqtt_protocol == mqtt_client.MQTTv5:
+        # Only available in paho-mqtt >= 1.5.1; protocol has been demoted in __init__ otherwise
+        from paho.mqtt.properties import Properties
+        from paho.mqtt.packettypes import PacketTypes
+
+        # Without a session expiry interval, the broker discards the session on disconnect
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.__mqtt_session_expiry
+
         if self.__mqtt_cleansession:
-          # TODO
-          # For clean_start set to True or Start_first_Only, a session expiry interval
-          # has to be set via properties object
-          # This is not yet implemented
-          self.__mqtt.connect_async(host=self.__mqtt_broker,
-                                    port=self.__mqtt_port,
-                                    keepalive=self.__keepalive,
-                                    clean_start=mqtt_client.MQTT_CLEAN_START_FIRST_ONLY,
-                                    properties=None)
+          clean_start = mqtt_client.MQTT_CLEAN_START_FIRST_ONLY
         else:
-          self.__mqtt.connect_async(host=self.__mqtt_broker,
-                                    port=self.__mqtt_port,
-                                    keepalive=self.__keepalive,
-                                    clean_start=False,
-                                    properties=None)
+          clean_start = False
+
+        self.__mqtt.connect_async(host=self.__mqtt_broker,
+                                  port=self.__mqtt_port,
+                                  keepalive=self.__keepalive,
+                                  clean_start=clean_start,
+                                  properties=properties)
       else:
         logger.error(f"Unknown MQTT protocol version {self.__mqtt_protocol}....exit")
         self.__worker_threads_stopper.set()
@@ -575,26 +621,9 @@ class MQTTClient(threading.Thread):
       logger.info(f"Start mqtt loop...")
       self.__mqtt.loop_start()
 
-    # Start infinite loop which sends queued messages every second
-    while not self.__mqtt_stopper.is_set():
-      # Todo: reconnect stuff needed?
-
-      # Check connection status
-      # If disconnected time exceeds threshold
-      # then reconnect
-      if not self.__connected_flag:
-        disconnect_time = int(time.time()) - self.__disconnect_start_time
-        logger.debug(f"Disconnect TIMER = {disconnect_time}")
-        if disconnect_time > self.__MQTT_CONNECTION_TIMEOUT:
-          try:
-            self.__mqtt.reconnect()
-          except Exception as e:
-            logger.exception(f"Exception {format(e)}")
-
-            # reconnect failed....reset disconnect time, and retry after self.__MQTT_CONNECTION_TIMEOUT
-            self.__disconnect_start_time = int(time.time())
-
-      time.sleep(0.1)
+    # paho loop thread handles network traffic and reconnects (with backoff, see reconnect_delay_set())
+    # Block till stopper is set; no need to wake up periodically
+    self.__mqtt_stopper.wait()
 
     # Close mqtt broker
     logger.debug(f"Close down MQTT client & connection to broker")
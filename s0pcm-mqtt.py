@@ -4,9 +4,8 @@
  DESCRIPTION
    Read S0 Pulse Meter
 
-4 Worker threads:
-  - S0 Pulse/USB Serial port reader
-  - Telegram parser to MQTT messages
+3 Worker threads:
+  - S0 Pulse/USB Serial port reader; parses telegrams to MQTT messages
   - MQTT client
   - HA Discovery
 
@@ -27,7 +26,7 @@
   - Update for mqtt lib v5
 """
 
-__version__ = "1.2.0"
+__version__ = "1.3.0"
 __author__ = "Hans IJntema"
 __license__ = "GPLv3"
 
@@ -59,18 +58,33 @@ import os
 script = os.path.basename(__file__)
 script = os.path.splitext(script)[0]
 
-# Ensure that only one instance is started
-if sys.platform == "linux":
+# Socket which holds the singleton lock; keep reference for process lifetime
+lock_socket = None
+
+
+def acquire_singleton():
+  """
+  Ensure that only one instance is started
+  Called from main(), after signal handlers are installed
+
+  Returns:
+    socket: abstract socket holding the lock (linux only), None otherwise
+  """
+  if sys.platform != "linux":
+    return None
+
   lockfile = "\0" + script + "_lockfile"
   try:
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.setblocking(False)
     # Create an abstract socket, by prefixing it with null.
     s.bind(lockfile)
-    logger.info(f"Starting {__file__}; version = {__version__}")
   except IOError as err:
     logger.info(f"{lockfile} already running. Exiting; {err}")
     sys.exit(1)
 
+  return s
+
 
 def close():
   """
@@ -87,32 +101,9 @@ def close():
 # ------------------------------------------------------------------------------------
 # LATE GLOBALS
 # ------------------------------------------------------------------------------------
-trigger = threading.Event()
 t_threads_stopper = threading.Event()
 t_mqtt_stopper = threading.Event()
 
-# mqtt thread
-t_mqtt = mqtt.MQTTClient(mqtt_broker=cfg.MQTT_BROKER,
-                         mqtt_port=cfg.MQTT_PORT,
-                         mqtt_client_id=cfg.MQTT_CLIENT_UNIQ,
-                         mqtt_qos=cfg.MQTT_QOS,
-                         mqtt_cleansession=True,
-                         mqtt_protocol=mqtt.MQTTv5,
-                         username=cfg.MQTT_USERNAME,
-                         password=cfg.MQTT_PASSWORD,
-                         mqtt_stopper=t_mqtt_stopper,
-                         worker_threads_stopper=t_threads_stopper)
-
-# SerialPort thread
-telegram = list()
-t_serial = s0.TaskReadSerial(trigger, t_threads_stopper, telegram)
-
-# Telegram parser thread
-t_parse = convert.ParseTelegrams(trigger, t_threads_stopper, t_mqtt, telegram)
-
-# Send Home Assistant auto discovery MQTT's
-t_discovery = ha.Discovery(t_threads_stopper, t_mqtt, __version__)
-
 
 def exit_gracefully(signal, stackframe):
   """
@@ -134,20 +125,52 @@ def exit_gracefully(signal, stackframe):
 
 
 def main():
+  global lock_socket
   logger.debug(">>")
 
+  lock_socket = acquire_singleton()
+  logger.info(f"Starting {__file__}; version = {__version__}")
+
+  # Create threads after lock is acquired; TaskReadSerial opens the serial port
+  # mqtt thread
+  t_mqtt = mqtt.MQTTClient(mqtt_broker=cfg.MQTT_BROKER,
+                           mqtt_port=cfg.MQTT_PORT,
+                           mqtt_client_id=cfg.MQTT_CLIENT_UNIQ,
+                           mqtt_qos=cfg.MQTT_QOS,
+                           mqtt_keepalive=getattr(cfg, "MQTT_KEEPALIVE", 60),
+                           mqtt_cleansession=True,
+                           mqtt_protocol=mqtt.MQTTv5,
+                           username=cfg.MQTT_USERNAME,
+                           password=cfg.MQTT_PASSWORD,
+                           mqtt_stopper=t_mqtt_stopper,
+                           worker_threads_stopper=t_threads_stopper)
+
+  # Telegram parser; called from SerialPort thread
+  parser = convert.ParseTelegrams(t_mqtt)
+
+  # SerialPort thread
+  t_serial = s0.TaskReadSerial(t_threads_stopper, parser)
+
+  # Send Home Assistant auto discovery MQTT's
+  t_discovery = ha.Discovery(t_threads_stopper, t_mqtt, __version__)
+
+  # Status & version in one retained JSON message
+  status_topic = cfg.MQTT_TOPIC_PREFIX + "/status"
+  status = {"state": "online", "version": __version__, "mqtt_version": mqtt.__version__}
+
   # Set last will/testament
-  t_mqtt.will_set(cfg.MQTT_TOPIC_PREFIX + "/status", payload="interrupted", qos=cfg.MQTT_QOS, retain=True)
+  t_mqtt.will_set(status_topic, payload=dict(status, state="interrupted"), qos=cfg.MQTT_QOS, retain=True)
 
   # Start all threads
   t_mqtt.start()
-  t_parse.start()
   t_discovery.start()
   t_serial.start()
 
   # Set status to online
-  t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "online", retain=True)
-  t_mqtt.do_publish(cfg.MQTT_TOPIC_PREFIX + "/sw-version", f"main={__version__}; mqtt={mqtt.__version__}", retain=True)
+  t_mqtt.set_status(status_topic, status, retain=True)
+
+  # Remove retained sw-version message of versions < 1.3.0; version is part of status message
+  t_mqtt.do_publish(cfg.MQTT_TOPIC_PREFIX + "/sw-version", "", retain=True)
 
   # block till t_serial stops receiving telegrams/exits
   t_serial.join()
@@ -155,12 +178,12 @@ def main():
   t_threads_stopper.set()
 
   # Set status to offline
-  t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "offline", retain=True)
+  t_mqtt.set_status(status_topic, dict(status, state="offline"), retain=True)
 
   # Use a simple delay of 1sec before closing mqtt
   # Should be normally enough to flush all MQTT messages
   time.sleep(1)
-  t_mqtt_stopper.set()
+  t_mqtt.stop()
 
   logger.debug("<<")
   return